@@ -4,6 +4,7 @@ import sys
 import threading
 import time
 import unittest
+from io import BytesIO
 
 import web
 
@@ -287,6 +288,8 @@ class ApplicationTest(unittest.TestCase):
                 if path == "/multipart":
                     i = web.input(file={})
                     return i.file.value
+                elif path == "/raw":
+                    return repr(sorted(web.webapi.rawinput("post").items()))
                 else:
                     i = web.input()
                     return repr(dict(i)).replace("u", "")
@@ -310,6 +313,145 @@ class ApplicationTest(unittest.TestCase):
 
         self.assertEqual(response.data, b"a")
 
+        data = '--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\nfoo\r\n--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\nbar\r\n--boundary\r\nContent-Disposition: form-data; name="y"\r\n\r\nbaz\r\n--boundary--\r\n'
+        response = app.request("/raw", method="POST", data=data, headers=headers)
+        self.assertEqual(response.data, b"[('x', ['foo', 'bar']), ('y', 'baz')]")
+
+    def test_fieldstorage_value(self):
+        data = (
+            '--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\nfoo\r\n'
+            '--boundary\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n\r\n'
+            + "a" * 2000
+            + "\r\n--boundary--\r\n"
+        ).encode("utf-8")
+        env = {
+            "REQUEST_METHOD": "POST",
+            "CONTENT_TYPE": "multipart/form-data; boundary=boundary",
+            "CONTENT_LENGTH": str(len(data)),
+        }
+        fs = web.webapi.cgiFieldStorage(fp=BytesIO(data), environ=env)
+
+        # in-memory parts keep their value after the first read.
+        self.assertEqual(fs["x"].value, "foo")
+        self.assertIn("value", fs["x"].__dict__)
+        self.assertEqual(fs["x"].value, "foo")
+
+        # parts backed by a temporary file are read again every time.
+        self.assertEqual(fs["file"].value, b"a" * 2000)
+        self.assertNotIn("value", fs["file"].__dict__)
+        self.assertEqual(fs["file"].value, b"a" * 2000)
+
+    def test_input_urlencoded(self):
+        urls = ("/", "index")
+
+        class index:
+            def GET(self):
+                return repr(sorted(web.input(a=[]).items()))
+
+            def POST(self):
+                return repr(sorted(web.input(a=[], _method="post").items()))
+
+        app = web.application(urls, locals())
+
+        response = app.request("/?a=1&b=x+y&a=%C3%A9&c")
+        self.assertEqual(
+            response.data.decode("utf-8"),
+            repr([("a", ["1", "\xe9"]), ("b", "x y"), ("c", "")]),
+        )
+
+        response = app.request("/?c=3", method="POST", data="a=1&b=2&a=")
+        self.assertEqual(
+            response.data.decode("utf-8"),
+            repr([("a", ["1", ""]), ("b", "2"), ("c", "3")]),
+        )
+
+    def test_data(self):
+        # fmt: off
+        urls = (
+            "/", "index",
+            "/input", "form",
+        )
+        # fmt: on
+
+        class index:
+            def POST(self):
+                return web.data()
+
+        class form:
+            def POST(self):
+                return repr(sorted(web.input().items()))
+
+        app = web.application(urls, locals())
+        multipart = '--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\n0123456789\r\n--boundary--\r\n'
+        multipart_headers = {"Content-Type": "multipart/form-data; boundary=boundary"}
+
+        def request_without_length(path, data):
+            env = {
+                "REQUEST_METHOD": "POST",
+                "PATH_INFO": path,
+                "CONTENT_TYPE": multipart_headers["Content-Type"],
+                "wsgi.input": BytesIO(data.encode("utf-8")),
+            }
+            response = web.storage()
+
+            def start_response(status, headers):
+                response.status = status
+
+            response.data = b"".join(app.wsgifunc()(env, start_response))
+            return response
+
+        response = app.request("/", method="POST", data="0123456789")
+        self.assertEqual(response.data, b"0123456789")
+
+        body = "x" * 100000
+        headers = {"Transfer-Encoding": "chunked"}
+        response = app.request("/", method="POST", data=body, headers=headers)
+        self.assertEqual(response.data, body.encode("utf-8"))
+
+        web.config.max_body_size = 5
+        try:
+            response = app.request("/", method="POST", data="0123456789")
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+
+            response = app.request("/", method="POST", data=body, headers=headers)
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+
+            response = app.request(
+                "/input", method="POST", data=multipart, headers=multipart_headers
+            )
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+
+            response = request_without_length("/input", multipart)
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+
+            web.config.max_body_size = len(multipart)
+            response = request_without_length("/input", multipart)
+            self.assertEqual(response.data, b"[('x', '0123456789')]")
+        finally:
+            del web.config.max_body_size
+
+    def test_multipart_reads_content_length(self):
+        urls = ("/", "index")
+
+        class index:
+            def POST(self):
+                return web.input().x
+
+        app = web.application(urls, locals())
+
+        data = b'--boundary\r\nContent-Disposition: form-data; name="x"\r\n\r\nfoo\r\n--boundary--\r\n'
+        stream = BytesIO(data + b"trailing bytes")
+        env = {
+            "REQUEST_METHOD": "POST",
+            "PATH_INFO": "/",
+            "CONTENT_TYPE": "multipart/form-data; boundary=boundary",
+            "CONTENT_LENGTH": str(len(data)),
+            "wsgi.input": stream,
+        }
+        result = app.wsgifunc()(env, lambda status, headers: None)
+        self.assertEqual(b"".join(result), b"foo")
+        self.assertEqual(stream.read(), b"trailing bytes")
+
     def testCustomNotFound(self):
         urls_a = ("/", "a")
         urls_b = ("/", "b")
@@ -397,6 +539,22 @@ class ApplicationTest(unittest.TestCase):
         p = f("/?y=1&y=2&x=2")
         self.assertTrue(p == b"/?y=1&y=2&x=1" or p == b"/?x=1&y=1&y=2")
 
+        class twice:
+            def GET(self):
+                web.changequery(x=1)
+                return web.changequery(y=None)
+
+        app = web.application(("/", "twice"), locals())
+        self.assertEqual(app.request("/?y=1&z=2").data, b"/?z=2")
+
+        class mutate:
+            def GET(self):
+                web.webapi.rawinput()["a"].append("3")
+                return repr(web.input(a=[]).a)
+
+        app = web.application(("/", "mutate"), locals())
+        self.assertEqual(app.request("/?a=1&a=2").data, b"['1', '2']")
+
     def test_setcookie(self):
         urls = ("/", "index")
 
@@ -414,6 +572,51 @@ class ApplicationTest(unittest.TestCase):
         self.assertEqual(f(""), "foo=bar; Path=/")
         self.assertEqual(f("/admin"), "foo=bar; Path=/admin/")
 
+    def test_setcookie_attributes(self):
+        urls = ("/", "index")
+
+        class index:
+            def GET(self):
+                web.setcookie(
+                    "foo",
+                    "a b",
+                    expires="Thu, 01 Jan 1970 00:00:00 GMT",
+                    domain="example.com",
+                    secure=True,
+                    httponly=True,
+                    samesite="Lax",
+                )
+                return "hello"
+
+        app = web.application(urls, locals())
+        response = app.request("/")
+        self.assertEqual(
+            response.headers["Set-Cookie"],
+            "foo=a%20b; Domain=example.com; expires=Thu, 01 Jan 1970 00:00:00 GMT; "
+            "HttpOnly; Path=/; Secure; SameSite=Lax",
+        )
+
+    def test_header_unique(self):
+        urls = ("/", "index")
+
+        class index:
+            def GET(self):
+                web.header("X-Foo", "1")
+                web.header("x-foo", "2", unique=True)
+                web.ctx.headers.append(("X-Bar", "1"))
+                web.header("X-BAR", "2", unique=True)
+                web.header("X-Foo", "3")
+                web.ctx.headers[1] = ("X-Baz", "1")
+                web.header("x-baz", "2", unique=True)
+                return "hello"
+
+        app = web.application(urls, locals())
+        response = app.request("/")
+        self.assertEqual(
+            response.header_items,
+            [("X-Foo", "1"), ("X-Baz", "1"), ("X-Foo", "3")],
+        )
+
     def test_stopsimpleserver(self):
         urls = ("/", "index")
 
@@ -3,13 +3,19 @@ Web API (wrapper around WSGI)
 (from web.py)
 """
 
+import calendar
 import cgi
+import datetime
+import io
 import pprint
+import re
 import sys
 import tempfile
-from http.cookies import CookieError, Morsel, SimpleCookie
-from io import BytesIO
-from urllib.parse import quote, unquote, urljoin
+import time
+from email.utils import formatdate
+from http.cookies import CookieError, SimpleCookie
+from io import BytesIO, StringIO
+from urllib.parse import quote, unquote, unquote_plus, urljoin
 
 from .utils import dictadd, intget, safestr, storage, storify, threadeddict
 
@@ -43,7 +49,7 @@ __all__ = [
     "seeother",
     "notmodified",
     "tempredirect",
-    # 400, 401, 403, 404, 405, 406, 409, 410, 412, 415, 451
+    # 400, 401, 403, 404, 405, 406, 409, 410, 412, 413, 415, 451
     "BadRequest",
     "Unauthorized",
     "Forbidden",
@@ -53,6 +59,7 @@ __all__ = [
     "Conflict",
     "Gone",
     "PreconditionFailed",
+    "RequestEntityTooLarge",
     "UnsupportedMediaType",
     "UnavailableForLegalReasons",
     "badrequest",
@@ -64,6 +71,7 @@ __all__ = [
     "conflict",
     "gone",
     "preconditionfailed",
+    "requestentitytoolarge",
     "unsupportedmediatype",
     "unavailableforlegalreasons",
     # 500
@@ -77,9 +85,21 @@ A configuration object for various aspects of web.py.
 
 `debug`
    : when True, enables reloading, disabled template caching and sets internalerror to debugerror.
+
+`max_body_size`
+   : when set, `web.data()` and `web.input()` reject request bodies larger than
+     this many bytes with `413 Request Entity Too Large`. This includes multipart
+     uploads, which are read at most one byte past the limit when the request
+     has no Content-Length.
 """
 
 
+# HTTPError only reads the headers it is given, so the error classes share these.
+_no_headers = {}
+_html_headers = {"Content-Type": "text/html"}
+_html_utf8_headers = {"Content-Type": "text/html; charset=utf-8"}
+
+
 class HTTPError(Exception):
     def __init__(self, status, headers={}, data=""):
         ctx.status = status
@@ -90,15 +110,16 @@ class HTTPError(Exception):
 
 
 def _status_code(status, data=None, classname=None, docstring=None):
+    reason = status.split(" ", 1)[1]
     if data is None:
-        data = status.split(" ", 1)[1]
-    classname = status.split(" ", 1)[1].replace(
-        " ", ""
-    )  # 304 Not Modified -> NotModified
+        data = reason
+    classname = classname or reason.replace(" ", "")  # 304 Not Modified -> NotModified
     docstring = docstring or "`%s` status" % status
 
-    def __init__(self, data=data, headers={}):
-        HTTPError.__init__(self, status, headers, data)
+    http_error_init = HTTPError.__init__
+
+    def __init__(self, data=data, headers=None):
+        http_error_init(self, status, headers or _no_headers, data)
 
     # trick to create class dynamically with dynamic docstring.
     return type(
@@ -184,7 +205,7 @@ class BadRequest(HTTPError):
 
     def __init__(self, message=None):
         status = "400 Bad Request"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -198,7 +219,7 @@ class Unauthorized(HTTPError):
 
     def __init__(self, message=None):
         status = "401 Unauthorized"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -212,7 +233,7 @@ class Forbidden(HTTPError):
 
     def __init__(self, message=None):
         status = "403 Forbidden"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -226,7 +247,7 @@ class _NotFound(HTTPError):
 
     def __init__(self, message=None):
         status = "404 Not Found"
-        headers = {"Content-Type": "text/html; charset=utf-8"}
+        headers = _html_utf8_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -243,6 +264,9 @@ def NotFound(message=None):
 notfound = NotFound
 
 
+_std_methods = ("GET", "HEAD", "POST", "PUT", "DELETE")
+
+
 class NoMethod(HTTPError):
     """A `405 Method Not Allowed` error."""
 
@@ -253,7 +277,7 @@ class NoMethod(HTTPError):
         headers = {}
         headers["Content-Type"] = "text/html"
 
-        methods = ["GET", "HEAD", "POST", "PUT", "DELETE"]
+        methods = _std_methods
         if cls:
             methods = [method for method in methods if hasattr(cls, method)]
 
@@ -271,7 +295,7 @@ class NotAcceptable(HTTPError):
 
     def __init__(self, message=None):
         status = "406 Not Acceptable"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -285,7 +309,7 @@ class Conflict(HTTPError):
 
     def __init__(self, message=None):
         status = "409 Conflict"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -299,7 +323,7 @@ class Gone(HTTPError):
 
     def __init__(self, message=None):
         status = "410 Gone"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -313,13 +337,27 @@ class PreconditionFailed(HTTPError):
 
     def __init__(self, message=None):
         status = "412 Precondition Failed"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
 preconditionfailed = PreconditionFailed
 
 
+class RequestEntityTooLarge(HTTPError):
+    """`413 Request Entity Too Large` error."""
+
+    message = "request entity too large"
+
+    def __init__(self, message=None):
+        status = "413 Request Entity Too Large"
+        headers = _html_headers
+        HTTPError.__init__(self, status, headers, message or self.message)
+
+
+requestentitytoolarge = RequestEntityTooLarge
+
+
 class UnsupportedMediaType(HTTPError):
     """`415 Unsupported Media Type` error."""
 
@@ -327,7 +365,7 @@ class UnsupportedMediaType(HTTPError):
 
     def __init__(self, message=None):
         status = "415 Unsupported Media Type"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -341,7 +379,7 @@ class _UnavailableForLegalReasons(HTTPError):
 
     def __init__(self, message=None):
         status = "451 Unavailable For Legal Reasons"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -365,7 +403,7 @@ class _InternalError(HTTPError):
 
     def __init__(self, message=None):
         status = "500 Internal Server Error"
-        headers = {"Content-Type": "text/html"}
+        headers = _html_headers
         HTTPError.__init__(self, status, headers, message or self.message)
 
 
@@ -382,6 +420,10 @@ def InternalError(message=None):
 internalerror = InternalError
 
 
+# size of the reads from wsgi.input.
+_read_size = 32 * 1024
+
+
 class cgiFieldStorage(cgi.FieldStorage):
     """
     Subclass cgi.FieldStorage, as read_binary expects fp to return
@@ -391,6 +433,8 @@ class cgiFieldStorage(cgi.FieldStorage):
     to incorrect encoding in Python 3.
     """
 
+    bufsize = _read_size
+
     def make_file(self, binary=None):
         """
         For backwards compatibility with Python 2, make_file accepted
@@ -398,6 +442,45 @@ class cgiFieldStorage(cgi.FieldStorage):
         """
         return tempfile.TemporaryFile("wb+")
 
+    def __getattr__(self, name):
+        """
+        cgi.FieldStorage computes `value` in __getattr__ by reading the
+        whole file on every access. Values already held in memory are
+        stored on the instance after the first read, so later accesses are
+        plain attribute lookups. Values backed by a temporary file are not
+        kept around.
+        """
+        value = cgi.FieldStorage.__getattr__(self, name)
+        if isinstance(self.file, (BytesIO, StringIO)):
+            self.value = value
+        return value
+
+
+class _InputReader(io.RawIOBase):
+    """
+    Raw reader over wsgi.input that stops after `length` bytes.
+
+    Used with io.BufferedReader so that cgi.FieldStorage's many small
+    readline calls are served from a large buffer without ever reading
+    past the end of the request body.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.stream.read(size)
+        b[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
 
 def header(hdr, value, unique=False):
     """
@@ -411,59 +494,140 @@ def header(hdr, value, unique=False):
     if "\n" in hdr or "\r" in hdr or "\n" in value or "\r" in value:
         raise ValueError("invalid characters in header")
     if unique is True:
+        name = hdr.lower()
         for h, v in ctx.headers:
-            if h.lower() == hdr.lower():
+            if h.lower() == name:
                 return
 
     ctx.headers.append((hdr, value))
 
 
+def _parse_qs_flat(qs):
+    """
+    Parses a query string in a single pass, keeping blank values.
+
+    A name that occurs once maps to its value and a name that occurs more
+    than once maps to the list of its values.
+
+        >>> sorted(_parse_qs_flat("a=1&b=x+y&a=%C3%A9&c").items())
+        [('a', ['1', '\xe9']), ('b', 'x y'), ('c', '')]
+        >>> _parse_qs_flat("")
+        {}
+    """
+    result = {}
+    for field in qs.split("&"):
+        if not field:
+            continue
+        key, sep, value = field.partition("=")
+        key = unquote_plus(key)
+        value = unquote_plus(value)
+        if key not in result:
+            result[key] = value
+        elif isinstance(result[key], list):
+            result[key].append(value)
+        else:
+            result[key] = [result[key], value]
+    return result
+
+
+_write_methods = frozenset(["both", "post", "put", "patch"])
+_read_methods = frozenset(["both", "get"])
+_body_methods = frozenset(["POST", "PUT", "PATCH"])
+
+
 def rawinput(method=None):
-    """Returns storage object with GET or POST arguments."""
-    method = method or "both"
+    """
+    Returns storage object with GET or POST arguments.
 
-    def dictify(fs):
-        # hack to make web.input work with enctype='text/plain.
-        if fs.list is None:
-            fs.list = []
+    The arguments are parsed once per request and method, later calls
+    return a copy of the cached result. List values are copied as well, but
+    uploaded files are the same FieldStorage objects on every call.
+    """
+    method = (method or "both").lower()
 
-        return {k: fs[k] for k in fs}
+    cache = ctx.get("_rawinput_cache")
+    if cache is None:
+        cache = ctx._rawinput_cache = {}
+    if method in cache:
+        return _copy_input(cache[method])
+
+    def process_fieldstorage(fs):
+        if isinstance(fs, list):
+            return [process_fieldstorage(x) for x in fs]
+        elif fs.filename is None:
+            return fs.value
+        else:
+            return fs
 
-    e = ctx.env.copy()
+    def dictify(fs):
+        # group the parts by name in a single pass, FieldStorage.__getitem__
+        # would scan all the parts again for every name.
+        # fs.list is None with enctype='text/plain'.
+        parts = {}
+        for part in fs.list or []:
+            parts.setdefault(part.name, []).append(part)
+
+        return {
+            k: process_fieldstorage(v if len(v) > 1 else v[0]) for k, v in parts.items()
+        }
+
+    e = ctx.env
+    request_method = e.get("REQUEST_METHOD", "GET")
     a = b = {}
 
-    if method.lower() in ["both", "post", "put", "patch"]:
-        if e["REQUEST_METHOD"] in ["POST", "PUT", "PATCH"]:
-            if e.get("CONTENT_TYPE", "").lower().startswith("multipart/"):
+    if method in _write_methods:
+        if request_method in _body_methods:
+            # a POST without a Content-Type is taken as a urlencoded form.
+            default_type = (
+                "application/x-www-form-urlencoded" if request_method == "POST" else ""
+            )
+            content_type = e.get("CONTENT_TYPE", default_type)
+            if content_type.lower().startswith("multipart/"):
                 # since wsgi.input is directly passed to cgi.FieldStorage,
                 # it can not be called multiple times. Saving the FieldStorage
                 # object in ctx to allow calling web.input multiple times.
                 a = ctx.get("_fieldstorage")
                 if not a:
                     fp = e["wsgi.input"]
+                    cl = intget(e.get("CONTENT_LENGTH"), -1)
+                    max_size = config.get("max_body_size")
+                    if max_size is not None and cl > max_size:
+                        raise requestentitytoolarge()
+                    reader = None
+                    if cl >= 0:
+                        fp = io.BufferedReader(_InputReader(fp, cl), _read_size)
+                    elif max_size is not None:
+                        # without a length, read one byte past the limit to
+                        # find out if the body is too large.
+                        reader = _InputReader(fp, max_size + 1)
+                        fp = io.BufferedReader(reader, _read_size)
                     a = cgiFieldStorage(fp=fp, environ=e, keep_blank_values=1)
+                    if reader is not None and reader.remaining == 0:
+                        raise requestentitytoolarge()
                     ctx._fieldstorage = a
-            else:
+                a = dictify(a)
+            elif (
+                content_type.split(";", 1)[0].strip()
+                == "application/x-www-form-urlencoded"
+            ):
                 d = data()
-                if isinstance(d, str):
-                    d = d.encode("utf-8")
-                fp = BytesIO(d)
-                a = cgiFieldStorage(fp=fp, environ=e, keep_blank_values=1)
-            a = dictify(a)
+                if isinstance(d, bytes):
+                    d = d.decode("utf-8", "replace")
+                # like cgi.FieldStorage, include the query string arguments.
+                if e.get("QUERY_STRING"):
+                    d += "&" + e["QUERY_STRING"]
+                a = _parse_qs_flat(d)
 
-    if method.lower() in ["both", "get"]:
-        e["REQUEST_METHOD"] = "GET"
-        b = dictify(cgiFieldStorage(environ=e, keep_blank_values=1))
+    if method in _read_methods:
+        b = _parse_qs_flat(e.get("QUERY_STRING", ""))
+
+    cache[method] = result = dictadd(b, a)
+    return _copy_input(result)
 
-    def process_fieldstorage(fs):
-        if isinstance(fs, list):
-            return [process_fieldstorage(x) for x in fs]
-        elif fs.filename is None:
-            return fs.value
-        else:
-            return fs
 
-    return storage([(k, process_fieldstorage(v)) for k, v in dictadd(b, a).items()])
+def _copy_input(d):
+    """Copies the cached input `d`, including its list values, into a storage."""
+    return storage((k, list(v) if isinstance(v, list) else v) for k, v in d.items())
 
 
 def input(*requireds, **defaults):
@@ -481,14 +645,71 @@ def input(*requireds, **defaults):
 
 
 def data():
-    """Returns the data sent with the request."""
-    if "data" not in ctx:
-        if ctx.env.get("HTTP_TRANSFER_ENCODING") == "chunked":
-            ctx.data = ctx.env["wsgi.input"].read()
+    """
+    Returns the data sent with the request.
+
+    Raises `413 Request Entity Too Large` if the body is larger than
+    `config.max_body_size`.
+    """
+    d = ctx.get("data")
+    if d is None:
+        env = ctx.env
+        max_size = config.get("max_body_size")
+        if env.get("HTTP_TRANSFER_ENCODING") == "chunked":
+            stream = env["wsgi.input"]
+            buf = BytesIO()
+            while True:
+                chunk = stream.read(_read_size)
+                if not chunk:
+                    break
+                buf.write(chunk)
+                if max_size is not None and buf.tell() > max_size:
+                    raise requestentitytoolarge()
+            d = buf.getvalue()
         else:
-            cl = intget(ctx.env.get("CONTENT_LENGTH"), 0)
-            ctx.data = ctx.env["wsgi.input"].read(cl)
-    return ctx.data
+            cl = intget(env.get("CONTENT_LENGTH"), 0)
+            if max_size is not None and cl > max_size:
+                raise requestentitytoolarge()
+            # don't touch the input stream when there is no body.
+            d = env["wsgi.input"].read(cl) if cl > 0 else b""
+        ctx.data = d
+    return d
+
+
+# same rules as http.cookies.Morsel for cookie names.
+_legal_cookie_name = re.compile(r"[\w!#$%&'*+\-.^`|~:]+", re.ASCII).fullmatch
+_reserved_cookie_names = frozenset(
+    [
+        "expires",
+        "path",
+        "comment",
+        "domain",
+        "max-age",
+        "secure",
+        "httponly",
+        "version",
+        "samesite",
+    ]
+)
+
+# values made only of these characters are left unchanged by quote().
+_cookie_unsafe_value = re.compile(r"[^A-Za-z0-9._-]").search
+
+
+def _cookie_expires(expires):
+    """
+    Formats `expires` for the Set-Cookie header.
+
+    An int is taken as seconds from now, a negative int expires the cookie
+    right away. A datetime is taken as UTC. Strings are used as they are.
+    """
+    if isinstance(expires, int):
+        if expires < 0:
+            expires = -1000000000
+        return formatdate(time.time() + expires, usegmt=True)
+    elif isinstance(expires, datetime.datetime):
+        return formatdate(calendar.timegm(expires.utctimetuple()), usegmt=True)
+    return expires
 
 
 def setcookie(
@@ -502,26 +723,32 @@ def setcookie(
     samesite=None,
 ):
     """Sets a cookie."""
-    morsel = Morsel()
     name, value = safestr(name), safestr(value)
-    morsel.set(name, value, quote(value))
-    if isinstance(expires, int) and expires < 0:
-        expires = -1000000000
-    morsel["expires"] = expires
-    morsel["path"] = path or ctx.homepath + "/"
+    if name.lower() in _reserved_cookie_names:
+        raise CookieError("Attempt to set a reserved key %r" % name)
+    if not _legal_cookie_name(name):
+        raise CookieError("Illegal key %r" % name)
+
+    if _cookie_unsafe_value(value):
+        value = quote(value)
+
+    # attributes are in the same order as http.cookies.Morsel writes them.
+    parts = ["%s=%s" % (name, value)]
     if domain:
-        morsel["domain"] = domain
-    if secure:
-        morsel["secure"] = secure
+        parts.append("Domain=%s" % domain)
+    if expires != "" and expires is not None:
+        parts.append("expires=%s" % _cookie_expires(expires))
     if httponly:
-        morsel["httponly"] = True
-    value = morsel.OutputString()
+        parts.append("HttpOnly")
+    parts.append("Path=%s" % (path or ctx.homepath + "/"))
+    if secure:
+        parts.append("Secure")
     if samesite and samesite.lower() in ("strict", "lax", "none"):
-        value += "; SameSite=%s" % samesite
-    header("Set-Cookie", value)
+        parts.append("SameSite=%s" % samesite)
+    header("Set-Cookie", "; ".join(parts))
 
 
-def parse_cookies(http_cookie):
+def parse_cookies(http_cookie, _unquote=unquote):
     r"""Parse a HTTP_COOKIE header and return dict of cookie names and decoded values.
 
     >>> sorted(parse_cookies('').items())
@@ -531,7 +758,7 @@ def parse_cookies(http_cookie):
     >>> sorted(parse_cookies('a=1%202').items())
     [('a', '1 2')]
     >>> sorted(parse_cookies('a=Z%C3%A9Z').items())
-    [('a', 'Z\xc3\xa9Z')]
+    [('a', 'ZéZ')]
     >>> sorted(parse_cookies('a=1; b=2; c=3').items())
     [('a', '1'), ('b', '2'), ('c', '3')]
 
@@ -546,31 +773,49 @@ def parse_cookies(http_cookie):
     [('keebler', 'E=mc2')]
     >>> sorted(parse_cookies(r'keebler="E=mc2; L=\"Loves\"; fudge=\012;"').items())
     [('keebler', 'E=mc2; L="Loves"; fudge=\n;')]
+    >>> sorted(parse_cookies('a=1%202; b="x y"; c=3').items())
+    [('a', '1 2'), ('b', 'x y'), ('c', '3')]
+    >>> sorted(parse_cookies('$Version=1; a=1; Path=/; b="x"').items())
+    [('a', '1'), ('b', 'x')]
     """
-    # print "parse_cookies"
-    if '"' in http_cookie:
-        # HTTP_COOKIE has quotes in it, use slow but correct cookie parsing
+    # `_unquote` is bound as a default argument to make it a local lookup.
+    # Use the fast parsing for the cookies before the first quoted value.
+    # From there on, the slow but correct SimpleCookie parsing is used,
+    # as a quoted value may itself contain ';'.
+    cookies = {}
+    quoted = None
+    offset = 0
+    for key_value in http_cookie.split(";"):
+        if '"' in key_value:
+            quoted = http_cookie[offset:]
+            break
+        offset += len(key_value) + 1
+        key, sep, value = key_value.partition("=")
+        if sep:
+            value = value.strip()
+            if "%" in value:
+                value = _unquote(value)
+            cookies[key.strip()] = value
+
+    if quoted is not None:
+        # SimpleCookie skips these names, skip them in the fast part too.
+        for key in list(cookies):
+            if key.startswith("$") or key.lower() in _reserved_cookie_names:
+                del cookies[key]
+
         cookie = SimpleCookie()
         try:
-            cookie.load(http_cookie)
+            cookie.load(quoted)
         except CookieError:
             # If HTTP_COOKIE header is malformed, try at least to load the cookies we can by
             # first splitting on ';' and loading each attr=value pair separately
             cookie = SimpleCookie()
-            for attr_value in http_cookie.split(";"):
+            for attr_value in quoted.split(";"):
                 try:
                     cookie.load(attr_value)
                 except CookieError:
                     pass
-        cookies = {k: unquote(v.value) for k, v in cookie.items()}
-    else:
-        # HTTP_COOKIE doesn't have quotes, use fast cookie parsing
-        cookies = {}
-        for key_value in http_cookie.split(";"):
-            key_value = key_value.split("=", 1)
-            if len(key_value) == 2:
-                key, value = key_value
-                cookies[key.strip()] = unquote(value.strip())
+        cookies.update((k, _unquote(v.value)) for k, v in cookie.items())
     return cookies
 
 